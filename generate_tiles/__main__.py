@@ -6,7 +6,7 @@ import argparse
 from .generate import generate_tiles
 from .logger import logger
 from .generate_list_of_empties import generate_empties_file
-from .create_archives import create_archive_commands
+from .create_archives import create_archive_commands, COMPRESSORS
 from .create_download_list import create_download_list
 
 
@@ -19,11 +19,11 @@ def _generate_tiles(ns: argparse.Namespace):
         logger.error('Maximum tile level must be at least 7. Otherwise, the intermediate tile chunks get too large.')
         sys.exit(1)
 
-    generate_tiles(ns.min_level, ns.max_level, ns.output_directory)
+    generate_tiles(ns.min_level, ns.max_level, ns.output_directory, processes=ns.processes, block_processes=ns.block_processes)
 
 
 def _generate_archive(ns: argparse.Namespace):
-    create_archive_commands(ns.max_level)
+    create_archive_commands(ns.max_level, compressor=ns.compressor, store_only=ns.store_only)
 
 
 def _generate_download(ns: argparse.Namespace):
@@ -57,12 +57,16 @@ if __name__ == '__main__':
     generate_tiles_parser.add_argument('--min-level', type=int, default=0, help='Minimum tile level. Default: 0')
     generate_tiles_parser.add_argument('--max-level', type=int, default=12, help='Maximum tile level. Default: 12')
     generate_tiles_parser.add_argument('--output-directory', type=str, default='tiles', help='Directory to create tile hierarchy in. Default: ./tiles/')
+    generate_tiles_parser.add_argument('--processes', type=int, default=None, help='Number of worker processes for merging the lower tile levels. Default: number of CPUs')
+    generate_tiles_parser.add_argument('--block-processes', type=int, default=2, help='Number of worker processes generating blocks of highest-level tiles. Each of these needs several GB of RAM. Default: 2')
     generate_tiles_parser.set_defaults(func=_generate_tiles)
 
 
     # action: generate archive and upload commands
     generate_archive_parser = sub.add_parser('generate-archive', help='Generate archive and upload commands.')
     generate_archive_parser.add_argument('--max-level', type=int, default=12, help='Maximum tile level. Default: 12')
+    generate_archive_parser.add_argument('--compressor', choices=sorted(COMPRESSORS.keys()), default='zip', help='Archive format to create. "pigz" and "zstd" create multi-threaded compressed tar archives, which are not understood by generate-download. "zstd" archives use long-distance matching and must be decompressed with "zstd -d --long". Default: zip')
+    generate_archive_parser.add_argument('--store-only', action='store_true', default=False, help='Store the tiles in the ZIP archives without compression (zip -0). The PNG tiles are already compressed, so this is considerably faster at almost the same archive size. Only applies to the zip compressor.')
     generate_archive_parser.set_defaults(func=_generate_archive)
 
 
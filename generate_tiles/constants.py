@@ -7,4 +7,6 @@ INTERMEDIATE_DTYPE = np.float32  # numpy ndarray representation for calculations
 IN_IMAGE_MODE = 'I;16B'  # PIL/Pillow image mode for input HGT images
 INTERMEDIATE_IMAGE_MODE = 'F'  # PIL/Pillow image mode for intermediate images
 INTERMEDIATE_NAN = 0  # "no value" value to use
-OUT_DTYPE = np.uint8
\ No newline at end of file
+HEIGHT_DTYPE = np.dtype('>u2')  # binary representation of the downscaled per-tile height maps
+OUT_DTYPE = np.uint8
+RESIZE_REDUCING_GAP = None  # Pillow reducing_gap when downscaling source data to tiles, None for a full resample
\ No newline at end of file
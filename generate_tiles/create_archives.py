@@ -1,11 +1,13 @@
 import sys
-from typing import Callable, Sequence, NamedTuple, Tuple
+from itertools import chain
+from typing import Callable, List, Sequence, NamedTuple, Tuple
 import json
 from pathlib import Path
 
-from .webmercatorcell import WebMercatorCell, generate_webmercator_grid
+import numpy as np
+
+from .webmercatorcell import WebMercatorCell, generate_webmercator_grid, cells_to_soa
 from .logger import logger
-from .mercator import invert_mercator
 from .prune_empties import load_empties, prune_empties
 
 
@@ -16,6 +18,29 @@ class ZipPackage(NamedTuple):
     tiles: Sequence[WebMercatorCell]
 
 
+def package_keys(levels: np.ndarray, i: np.ndarray, j: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Keys of the ZIP packages the given tiles are contained in. All tiles up
+    until level 5 share one package, tiles of level N (N >= 6) are grouped by
+    their parent tile of level N - 6.
+    '''
+    low = levels <= 5
+
+    return (
+        np.where(low, 0, levels),
+        np.where(low, 0, i >> 6),
+        np.where(low, 0, j >> 6),
+    )
+
+
+def package_name(key: Tuple[int, int, int]) -> str:
+    level, i, j = key
+    if level == 0:
+        return 'tiles__0_to_5'
+
+    return F'tiles__{level}__{level - 6}_{i}_{j}'
+
+
 def create_packages(max_level: int, prune_empty_nodes: bool = True) -> Sequence[ZipPackage]:
     packages: Sequence[ZipPackage] = []
 
@@ -25,29 +50,28 @@ def create_packages(max_level: int, prune_empty_nodes: bool = True) -> Sequence[
     if prune_empty_nodes:
         prune_empties(root)
 
-    all_cells = root.flatten()
+    cells_by_level = root.cells_by_level()
 
     # first file contains all tiles up until level 5
     packages.append(ZipPackage(
         (0, 0, 0),
-        'tiles__0_to_5',
+        package_name((0, 0, 0)),
         'All non-empty tiles of levels 0 to 5.',
-        list(filter(lambda v: v.level <= 5, all_cells)),
+        list(chain.from_iterable(cells_by_level[:6])),
     ))
 
     # other levels are split up into blocks
     # the blocks are the cells of the level minus 6 (e.g., for tile level 8, the 16 blocks from level 2 are used)
     for i in range(6, max_level + 1):
         block_level = i - 6
-        blocks = list(filter(lambda v: v.level == block_level, all_cells))
+        blocks = cells_by_level[block_level]
         logger.info('Splitting cells of level %d into %d blocks of level %d.', i, len(blocks), block_level)
         for block in blocks:
             key = (i, block.i, block.j)
-            filename = F'tiles__{i}__{block.level}_{block.i}_{block.j}'
-            lat0, lng0 = invert_mercator(block.x0, block.y0)
-            lat1, lng1 = invert_mercator(block.x1, block.y1)
+            filename = package_name(key)
+            lat0, lng0, lat1, lng1 = block.latlng_corners()
             description = F'All non-empty tiles of level {i} that lie within the block {block.i}/{block.j} of level {block.level}. This block covers the area between latitudes {lat0:.6f} and {lat1:.6f} and longitudes {lng0:.6f} and {lng1:.6f}.'
-            cells = list(filter(lambda v: v.level == i, block.flatten()))
+            cells = block.cells_at_level(i)
 
             packages.append(ZipPackage(key, filename, description, cells))
 
@@ -56,9 +80,40 @@ def create_packages(max_level: int, prune_empty_nodes: bool = True) -> Sequence[
     return packages
 
 
+def _sort_tiles(tiles: Sequence[WebMercatorCell]) -> List[WebMercatorCell]:
+    '''
+    Sort tiles by level, i, and j, using a vectorized sort on the tile indices
+    instead of constructing a key tuple per tile.
+    '''
+    levels, i, j = cells_to_soa(tiles)
+    return [tiles[k] for k in np.lexsort((j, i, levels))]
+
+
+# archive file extension, uploaded file extension, and upload MIME type per
+# compressor. DaRUS extracts ZIP files on upload, hence the ZIP files are
+# ZIP-ed again. tar archives are compressed using all available cores.
+COMPRESSORS = {
+    'zip': ('.zip', '.zip.zip', 'application/zip'),
+    'pigz': ('.tar.gz', '.tar.gz', 'application/gzip'),
+    'zstd': ('.tar.zst', '.tar.zst', 'application/zstd'),
+}
+
+
 def create_archive_commands(
     max_level: int = 12,
+    compressor: str = 'zip',
+    store_only: bool = False,
 ):
+    if compressor not in COMPRESSORS:
+        logger.error('Unknown compressor "%s".', compressor)
+        sys.exit(1)
+
+    extension, upload_extension, upload_mimetype = COMPRESSORS[compressor]
+
+    # the PNG tiles are already compressed, so storing them uncompressed
+    # saves time at virtually the same archive size
+    zip_options = ' -0 -q' if store_only else ' -q'
+
     p = Path('archive/')
     if p.exists():
         logger.error('Archive path already exists.')
@@ -66,55 +121,57 @@ def create_archive_commands(
 
     packages = create_packages(max_level)
 
-    manifest_file_content = []
-    archive_command_file_content = [
-        'archive_dir=$(pwd)/archive',
-        'tile_dir=$(pwd)/tiles',
-        'cd $tile_dir'
-    ]
-    upload_command_file_content = [
-        'export API_TOKEN=XXXX  # TODO: insert DaRUS token here',
-        'export SERVER_URL="https://darus.uni-stuttgart.de/"',
-        'export PERSISTENT_ID="doi:10.18419/darus-3837"'
-    ]
-
     p.mkdir(exist_ok=True)
 
-    for i, package in enumerate(packages):
-        fname = F'{package.filename}.zip'
-
-        manifest_file_content.append(F'{fname}:')
-
-        with open(F'archive/{package.filename}.contents', 'w') as f:
-            for cell in sorted(package.tiles, key=lambda v: (v.level, v.i, v.j)):
-                cell_file_name = F'{cell.level}/{cell.i}/{cell.j}.png'
-                print(cell_file_name, file=f)
-                manifest_file_content.append(F'  {cell_file_name}')
-
-        metadata = dict(
-            description=package.description,
-            directoryLabel='tiles',
-            categories=['Data'],
-            restrict='false',
-            tabIngest='false',
-        )
-        with open(F'archive/{package.filename}.metadata', 'w') as f:
-            json.dump(metadata, f)
-
-        archive_command_file_content.append(F'zip -q /tmp/{package.filename}.zip -@ < $archive_dir/{package.filename}.contents')
-        archive_command_file_content.append(F'( cd /tmp; zip -q $archive_dir/{package.filename}.zip.zip {package.filename}.zip )')
-        archive_command_file_content.append(F'rm /tmp/{package.filename}.zip')
-
-        upload_command_file_content.append(F'curl -H X-Dataverse-key:$API_TOKEN -X POST -F "file=@archive/{package.filename}.zip.zip;type=application/zip" -F "jsonData=@archive/{package.filename}.metadata" "$SERVER_URL/api/datasets/:persistentId/add?persistentId=$PERSISTENT_ID" > archive/{package.filename}.upload.log')
-
-        if i < len(packages) - 1:
-            manifest_file_content.append('')
-
-    with open('manifest.txt', 'w') as f:
-        [ print(l, file=f) for l in manifest_file_content ]
-
-    with open('archive_commands', 'w') as f:
-        [ print(l, file=f) for l in archive_command_file_content ]
-
-    with open('upload_commands', 'w') as f:
-        [ print(l, file=f) for l in upload_command_file_content ]
\ No newline at end of file
+    # the output files are written while iterating over the packages, so that
+    # the full manifest never has to be held in memory
+    with open('manifest.txt', 'w', buffering=1 << 20) as manifest_file, \
+            open('archive_commands', 'w', buffering=1 << 20) as archive_command_file, \
+            open('upload_commands', 'w', buffering=1 << 20) as upload_command_file:
+        archive_command_file.write('archive_dir=$(pwd)/archive\n')
+        archive_command_file.write('tile_dir=$(pwd)/tiles\n')
+        archive_command_file.write('cd $tile_dir\n')
+
+        upload_command_file.write('export API_TOKEN=XXXX  # TODO: insert DaRUS token here\n')
+        upload_command_file.write('export SERVER_URL="https://darus.uni-stuttgart.de/"\n')
+        upload_command_file.write('export PERSISTENT_ID="doi:10.18419/darus-3837"\n')
+
+        for i, package in enumerate(packages):
+            fname = F'{package.filename}{extension}'
+            upload_filename = F'{package.filename}{upload_extension}'
+
+            cell_file_names = [
+                F'{cell.level}/{cell.i}/{cell.j}.png'
+                for cell in _sort_tiles(package.tiles)
+            ]
+
+            with open(F'archive/{package.filename}.contents', 'w') as f:
+                f.write('\n'.join(cell_file_names) + '\n')
+
+            manifest_file.write(F'{fname}:\n')
+            manifest_file.write(''.join([F'  {cell_file_name}\n' for cell_file_name in cell_file_names]))
+            if i < len(packages) - 1:
+                manifest_file.write('\n')
+
+            metadata = dict(
+                description=package.description,
+                directoryLabel='tiles',
+                categories=['Data'],
+                restrict='false',
+                tabIngest='false',
+            )
+            # json.dumps uses the C encoder, json.dump falls back to the pure
+            # Python one and writes each token separately
+            with open(F'archive/{package.filename}.metadata', 'w') as f:
+                f.write(json.dumps(metadata))
+
+            if compressor == 'zip':
+                archive_command_file.write(F'zip{zip_options} /tmp/{package.filename}.zip -@ < $archive_dir/{package.filename}.contents\n')
+                archive_command_file.write(F'( cd /tmp; zip{zip_options} $archive_dir/{package.filename}.zip.zip {package.filename}.zip )\n')
+                archive_command_file.write(F'rm /tmp/{package.filename}.zip\n')
+            elif compressor == 'pigz':
+                archive_command_file.write(F'tar -cf - -T $archive_dir/{package.filename}.contents | pigz -p $(nproc) -9 > $archive_dir/{upload_filename}\n')
+            else:
+                archive_command_file.write(F'tar -cf - -T $archive_dir/{package.filename}.contents | zstd -q -T0 -19 --long > $archive_dir/{upload_filename}\n')
+
+            upload_command_file.write(F'curl -H X-Dataverse-key:$API_TOKEN -X POST -F "file=@archive/{upload_filename};type={upload_mimetype}" -F "jsonData=@archive/{package.filename}.metadata" "$SERVER_URL/api/datasets/:persistentId/add?persistentId=$PERSISTENT_ID" > archive/{package.filename}.upload.log\n')
@@ -2,15 +2,17 @@ import os.path
 import sys
 import argparse
 import os
-from typing import Sequence
+from typing import Any, Dict, Sequence, Tuple
 
+import ijson
+import numpy as np
 from geojson import Feature, FeatureCollection, Polygon, MultiPolygon, load
 from requests import Session
 
-from .webmercatorcell import WebMercatorCell, generate_webmercator_grid
+from .webmercatorcell import WebMercatorCell, generate_webmercator_grid, pack_cell_keys, unpack_cell_keys
 from .logger import logger
 from .generate_within_polygon import generate_within_polygon_checker
-from .create_archives import create_packages
+from .create_archives import package_keys, package_name
 from .prune_empties import load_empties
 from . import __version__
 
@@ -32,6 +34,47 @@ def _get_features(f: argparse.FileType) -> Sequence[Feature]:
     return features
 
 
+_VERSION_PREFIX = 'data.latestVersion'
+_TITLE_FIELD_PREFIX = 'data.latestVersion.metadataBlocks.citation.fields.item'
+_FILE_PREFIX = 'data.latestVersion.files.item'
+
+
+def _parse_dataset_manifest(stream) -> Tuple[Dict[str, Any], str | None, Dict[str, int]]:
+    '''
+    Incrementally parse the DaRUS dataset JSON. Only the version information,
+    the dataset title, and a look-up from file path to file ID are kept, so
+    the full file list never has to be held in memory.
+    '''
+    version = dict()
+    title = None
+    data_ids = dict()
+
+    builder = None
+    builder_prefix = None
+    for prefix, event, value in ijson.parse(stream):
+        if builder is None and event == 'start_map' and prefix in (_TITLE_FIELD_PREFIX, _FILE_PREFIX):
+            builder = ijson.ObjectBuilder()
+            builder_prefix = prefix
+
+        if builder is not None:
+            builder.event(event, value)
+
+            if event == 'end_map' and prefix == builder_prefix:
+                item = builder.value
+                builder = None
+
+                if builder_prefix == _FILE_PREFIX:
+                    path = os.path.join(item.get('directoryLabel', ''), item['label'])
+                    data_ids[path] = item['dataFile']['id']
+                elif item.get('typeName') == 'title' and title is None:
+                    title = item['value']
+
+        elif prefix in ('data.latestVersion.versionNumber', 'data.latestVersion.versionMinorNumber', 'data.latestVersion.versionState'):
+            version[prefix.removeprefix(F'{_VERSION_PREFIX}.')] = value
+
+    return version, title, data_ids
+
+
 def create_download_list(
     darus_url: str,
     darus_id: str,
@@ -56,38 +99,48 @@ def create_download_list(
 
     root = generate_webmercator_grid(outside_maxlevel)
     root.conditional_recursive_subdivide(checker, inside_maxlevel)
-    all_tiles = root.flatten()
+
+    # only the tile indices are needed from here on, so the tree is released
+    tile_levels, tile_i, tile_j = root.flatten_soa()
+    del root
 
     if polygon_file:
-        logger.info('Generated grid of %d tiles up to level %d, restricted to level %d outside of given polygon file.', len(all_tiles), inside_maxlevel, outside_maxlevel)
+        logger.info('Generated grid of %d tiles up to level %d, restricted to level %d outside of given polygon file.', len(tile_levels), inside_maxlevel, outside_maxlevel)
     else:
-        logger.info('Generated grid of %d tiles up to level %d.', len(all_tiles), inside_maxlevel)
+        logger.info('Generated grid of %d tiles up to level %d.', len(tile_levels), inside_maxlevel)
 
-    # generate tree with the archives
-    logger.info('Creating look-up table to determine what ZIP files to download.')
-    packages = create_packages(inside_maxlevel, prune_empty_nodes=False)
+    # the ZIP file a tile is contained in follows directly from its address
+    logger.info('Determining what ZIP files to download.')
     empty_checker = load_empties()
 
+    # group tiles by package. lexsort is stable, so the tiles retain their
+    # order within each package
+    key_levels, key_i, key_j = package_keys(tile_levels, tile_i, tile_j)
+    order = np.lexsort((key_j, key_i, key_levels))
+    key_levels, key_i, key_j = key_levels[order], key_i[order], key_j[order]
+    group_starts = np.flatnonzero(np.diff(key_levels, prepend=-1) | np.diff(key_i, prepend=-1) | np.diff(key_j, prepend=-1))
+    group_ends = np.append(group_starts[1:], len(order))
+
+    tile_empty = empty_checker.empty_mask(tile_levels, tile_i, tile_j)
+
     # determine list of archives to download
     package_tilelists = dict()
-    required_tile_set = { (tile.level, tile.i, tile.j) for tile in all_tiles }
-    required_empty_tiles = list()
 
     download_tile_count = 0
-    for package in packages:
-        tiles = list()
-        for tile in package.tiles:
-            if (tile.level, tile.i, tile.j) in required_tile_set:
-                if empty_checker(tile):
-                    required_empty_tiles.append(tile)
-                else:
-                    tiles.append(tile)
-
-        if len(tiles):
+    for start, end in zip(group_starts, group_ends):
+        key = (int(key_levels[start]), int(key_i[start]), int(key_j[start]))
+        indices = order[start:end]
+        indices = indices[~tile_empty[indices]]
+
+        if len(indices):
+            tiles = list(zip(tile_levels[indices].tolist(), tile_i[indices].tolist(), tile_j[indices].tolist()))
             download_tile_count += len(tiles)
-            package_tilelists[package.filename] = tiles
+            package_tilelists[package_name(key)] = tiles
+
+    # empty tiles are kept as sorted packed keys
+    required_empty_keys = np.sort(pack_cell_keys(tile_levels[tile_empty], tile_i[tile_empty], tile_j[tile_empty]))
 
-    logger.info('Identified %d tiles to be downloaded across %d ZIP files. %d empty tiles can be symlinked.', download_tile_count, len(package_tilelists), len(required_empty_tiles))
+    logger.info('Identified %d tiles to be downloaded across %d ZIP files. %d empty tiles can be symlinked.', download_tile_count, len(package_tilelists), len(required_empty_keys))
 
 
     # load manifest from DaRUS
@@ -107,27 +160,16 @@ def create_download_list(
         F'{darus_url}/api/datasets/:persistentId/',
         params={
             'persistentId': darus_id,
-        }
+        },
+        stream=True,
     )
+    request.raw.decode_content = True
 
-    data = request.json()['data']
+    version, dataset_title, data_ids = _parse_dataset_manifest(request.raw)
 
-    dataset_version = data['latestVersion'].get('versionNumber')
-    dataset_version_minor = data['latestVersion'].get('versionMinorNumber')
-    dataset_version_str = ':draft' if data['latestVersion'].get('versionState') == 'DRAFT' else F'{dataset_version}.{dataset_version_minor}'
-    dataset_title = next(filter(lambda v: v['typeName'] == 'title', data['latestVersion']['metadataBlocks']['citation']['fields']))['value']
-    file_data = data['latestVersion']['files']
+    dataset_version_str = ':draft' if version.get('versionState') == 'DRAFT' else F'{version.get("versionNumber")}.{version.get("versionMinorNumber")}'
 
-    logger.info('Got a manifest with %d files for version %s of dataset "%s".', len(file_data), dataset_version_str, dataset_title)
-
-    # parse file list, create look-up
-    data_ids = dict()
-    for file in file_data:
-        directory = file.get('directoryLabel', '')
-        path = os.path.join(directory, file['label'])
-        dataId = file['dataFile']['id']
-
-        data_ids[path] = dataId
+    logger.info('Got a manifest with %d files for version %s of dataset "%s".', len(data_ids), dataset_version_str, dataset_title)
 
 
     # collect required files
@@ -164,32 +206,29 @@ def create_download_list(
 
         for package_filename, tiles in package_tilelists.items():
             f.write(F'cat > $download_dir/{package_filename}.files <<EOF\n')
-            for tile in tiles:
-                f.write(F'{tile.level}/{tile.i}/{tile.j}.png\n')
+            f.write(''.join([F'{level}/{i}/{j}.png\n' for level, i, j in tiles]))
             f.write('EOF\n')
             f.write(F'xargs -a $download_dir/{package_filename}.files unzip -d $extraction_dir $download_dir/{package_filename}.zip\n\n')
 
 
-    # create softlink commands for empty tiles
-    softlink_dirs = set()
-    softlink_commands = list()
+    # create softlink commands for empty tiles. the packed keys are sorted, so
+    # the directory of a tile (level and i) is given by the upper bits
+    dir_levels, dir_i, _ = unpack_cell_keys(np.unique(required_empty_keys >> 29) << 29)
+    softlink_dirs = [F'{level}/{i}' for level, i in zip(dir_levels.tolist(), dir_i.tolist())]
 
-    for empty_tile in required_empty_tiles:
-        dir = F'{empty_tile.level}/{empty_tile.i}'
-        softlink_dirs.add(dir)
-        softlink_commands.append(F'ln -s $download_dir/empty.png $extraction_dir/{dir}/{empty_tile.j}.png\n')
+    empty_levels, empty_i, empty_j = unpack_cell_keys(required_empty_keys)
+    softlink_commands = [
+        F'ln -s $download_dir/empty.png $extraction_dir/{level}/{i}/{j}.png\n'
+        for level, i, j in zip(empty_levels.tolist(), empty_i.tolist(), empty_j.tolist())
+    ]
 
     with open('softlink_commands', 'w') as f:
         f.write('download_dir=$(pwd)/download   # change this if you want the downloads to go somewhere else\n')
         f.write('extraction_dir=$(pwd)/tiles    # change this if you want the extracted tiles to go somewhere else\n\n')
 
-        for d in sorted(softlink_dirs):
-            f.write(F'mkdir -p $extraction_dir/{d}\n')
-
+        f.write(''.join([F'mkdir -p $extraction_dir/{d}\n' for d in softlink_dirs]))
         f.write('\n')
-
-        for cmd in softlink_commands:
-            f.write(cmd)
+        f.write(''.join(softlink_commands))
 
 
     # create Leaflet layer code
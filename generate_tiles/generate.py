@@ -1,10 +1,12 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 from itertools import repeat
 import math
 import sys
 import os.path
+import threading
 from pathlib import Path
 from typing import Callable, Sequence, Tuple
-from multiprocessing.pool import Pool
 
 import numpy as np
 from PIL import Image
@@ -13,7 +15,7 @@ from .logger import logger
 from .webmercatorcell import WebMercatorCell, generate_webmercator_grid
 from .mercator import proj_mercator, invert_mercator
 from .imagetools import read_cell, equirectangular_image_to_mercator, to_hillshade
-from .constants import IN_IMAGE_MODE, INTERMEDIATE_DTYPE, DIM, INTERMEDIATE_IMAGE_MODE
+from .constants import IN_IMAGE_MODE, INTERMEDIATE_DTYPE, DIM, INTERMEDIATE_IMAGE_MODE, HEIGHT_DTYPE, RESIZE_REDUCING_GAP
 from .utils import LinearInterpolator
 from .prune_empties import EmptyChecker, prune_empties
 
@@ -30,6 +32,34 @@ def _get_latlng_extent(node: WebMercatorCell) -> Tuple[Sequence[Tuple[int, int]]
     return indices, lng_min, lng_max, lat_min, lat_max
 
 
+_join_buffer = threading.local()
+
+
+def _get_join_buffer(shape: Tuple[int, int]) -> np.ndarray:
+    '''
+    Mosaic buffer for ``_load_and_join_tiles``, kept per thread and reused as
+    long as the mosaic size does not change. Blocks of the same latitude band
+    have the same size, so consecutive blocks do not have to allocate and
+    fault in several GB of fresh memory each.
+
+    The buffer is only kept between blocks in the block worker processes,
+    which exit after all blocks are done. Everywhere else, it is released at
+    the end of each block by ``_release_join_buffer``.
+    '''
+    data = getattr(_join_buffer, 'data', None)
+    if data is None or data.shape != shape:
+        _join_buffer.data = None
+        data = np.ndarray(shape, INTERMEDIATE_DTYPE)
+        _join_buffer.data = data
+
+    return data
+
+
+def _release_join_buffer():
+    if not getattr(_join_buffer, 'keep', False):
+        _join_buffer.data = None
+
+
 def _load_and_join_tiles(
         node: WebMercatorCell,
         indices: Sequence[Tuple[int, int]],
@@ -45,7 +75,9 @@ def _load_and_join_tiles(
 
     px_width = (per_tile_size - overlap_size) * delta_lng + overlap_size
     px_height = (per_tile_size - overlap_size) * delta_lat + overlap_size
-    data = np.ndarray((px_height, px_width), INTERMEDIATE_DTYPE)
+    # every pixel is overwritten by the tiles below, so the buffer does not
+    # need to be cleared
+    data = _get_join_buffer((px_height, px_width))
 
     for lng, lat in indices:
         logger.debug('Loading SRTM tile at latitude %d, longitude %d.', lat, lng)
@@ -122,20 +154,29 @@ def _generate_tile_from_data(
     data_cropped = data[iy0:iy1, ix0:ix1].copy()
 
     cropped = Image.fromarray(data_cropped, mode=INTERMEDIATE_IMAGE_MODE)
-    cropped_resized = cropped.resize((256 + 16, 256 + 16), resample=Image.Resampling.BILINEAR)
+    cropped_resized = cropped.resize((256 + 16, 256 + 16), resample=Image.Resampling.BILINEAR, reducing_gap=RESIZE_REDUCING_GAP)
 
     # apply shading
-    img_with_margin = to_hillshade(np.array(cropped_resized))
+    img_with_margin = to_hillshade(np.asarray(cropped_resized, INTERMEDIATE_DTYPE))
 
     img = img_with_margin.crop((8, 8, 256+8, 256+8))
 
     dirname = _save_tile(node, tile_directory, img)
 
     heights = cropped_resized.convert(mode='I') \
-        .resize((128,128), box=(8, 8, 255+8, 255+8), resample=Image.Resampling.BILINEAR)
+        .resize((128,128), box=(8, 8, 255+8, 255+8), resample=Image.Resampling.BILINEAR, reducing_gap=RESIZE_REDUCING_GAP)
+
+    _save_heightdata(dirname, node.j, heights)
 
-    with open(os.path.join(dirname, F'{node.j}.hgt.pgm'), 'wb') as f:
-        heights.save(f, 'PPM')
+
+def _save_heightdata(dirname: str, j: int, heights: Image.Image):
+    '''
+    Store the 128x128 height map of a tile as raw big-endian unsigned 16 bit
+    integers, which can be read back without decoding. Heights are clipped
+    to that range, so areas below sea level are stored as 0.
+    '''
+    data = np.clip(np.asarray(heights), 0, np.iinfo(HEIGHT_DTYPE).max).astype(HEIGHT_DTYPE)
+    data.tofile(os.path.join(dirname, F'{j}.hgt.raw'))
 
 
 def _get_heightdata(tile_directory: str, level: int, i: int, j: int) -> np.ndarray:
@@ -145,17 +186,28 @@ def _get_heightdata(tile_directory: str, level: int, i: int, j: int) -> np.ndarr
     elif i >= maxindex:
         i = i - maxindex
 
-    fname = os.path.join(tile_directory, str(level), str(i), F'{j}.hgt.pgm')
+    return _read_heightdata(tile_directory, level, i, j)
+
+
+@lru_cache(maxsize=1024)
+def _read_heightdata(tile_directory: str, level: int, i: int, j: int) -> np.ndarray:
+    '''
+    Read the height data of a tile once per process. Neighbouring merged cells
+    use the same tiles for their margins, so most tiles are requested several
+    times. The returned array is read-only, as it is shared between callers.
+    '''
+    fname = os.path.join(tile_directory, str(level), str(i), F'{j}.hgt.raw')
     if not os.path.exists(fname):
         logger.debug('Height data for node %d/%d of level %d does not exist.', i, j, level)
-        return np.zeros((128, 128), INTERMEDIATE_DTYPE)
+        data = np.zeros((128, 128), INTERMEDIATE_DTYPE)
+    else:
+        data = np.fromfile(fname, HEIGHT_DTYPE).reshape((128, 128)).astype(INTERMEDIATE_DTYPE)
 
-    with open(fname, 'rb') as f:
-        img = Image.open(f, 'r').convert(mode='I;16B')
-        return np.asfarray(img, dtype=INTERMEDIATE_DTYPE)
+    data.flags.writeable = False
+    return data
 
 
-def generate_mercator_tile_grid(node: WebMercatorCell, tile_directory: str, checker: EmptyChecker, level: int = 12):
+def generate_mercator_tile_grid(node: WebMercatorCell, tile_directory: str, checker: EmptyChecker, level: int = 12, threads: int | None = None):
     if checker(node):
         logger.info('Node %s is fully empty and can be skipped.', node)
         return
@@ -187,7 +239,7 @@ def generate_mercator_tile_grid(node: WebMercatorCell, tile_directory: str, chec
 
     data_merc, _x_to_px, _y_to_px = _project_to_mercator(data, lng_min, lng_max, lat_min, lat_max, delta_lng, delta_lat)
 
-    node_list = list(filter(lambda v: v.level == level and not checker(v), node.flatten()))
+    node_list = [v for v in node.cells_at_level(level) if not checker(v)]
     logger.info('Generating %d tiles of level %d for node %d/%d of level %d.',
                 len(node_list),
                 level,
@@ -195,8 +247,36 @@ def generate_mercator_tile_grid(node: WebMercatorCell, tile_directory: str, chec
                 node.level,
                 )
 
-    for childnode in node_list:
-        _generate_tile_from_data(childnode, data_merc, _x_to_px, _y_to_px, tile_directory)
+    # the tiles only read from data_merc, and Pillow releases the GIL while
+    # resizing and encoding, so threads can share the projected data without
+    # copying it
+    generate = partial(_generate_tile_from_data, data=data_merc, xscale=_x_to_px, yscale=_y_to_px, tile_directory=tile_directory)
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+        list(executor.map(generate, node_list))
+
+    del data, data_merc
+    _release_join_buffer()
+
+
+_MERGE_MARGIN = 8
+
+# source and destination slices along one axis, for the subcell offsets -1 to
+# 2 of a merged cell: its own two subcells in the middle, and a margin from
+# the neighbouring subcells on either side
+_MERGE_AXIS_SLICES = {
+    -1: (slice(-_MERGE_MARGIN, None), slice(None, _MERGE_MARGIN)),
+    0: (slice(None), slice(_MERGE_MARGIN, 128+_MERGE_MARGIN)),
+    1: (slice(None), slice(128+_MERGE_MARGIN, 256+_MERGE_MARGIN)),
+    2: (slice(None, _MERGE_MARGIN), slice(256+_MERGE_MARGIN, None)),
+}
+
+# (di, dj, source slice, destination slice) for all 16 subcells that make up
+# a merged cell including its margin. rows are j, columns are i
+_MERGE_NEIGHBOURS = [
+    (di, dj, (source_y, source_x), (destination_y, destination_x))
+    for dj, (source_y, destination_y) in _MERGE_AXIS_SLICES.items()
+    for di, (source_x, destination_x) in _MERGE_AXIS_SLICES.items()
+]
 
 
 def _generate_merged_cell_from_subcells(cell: WebMercatorCell, tile_directory: str, level: int):
@@ -204,32 +284,13 @@ def _generate_merged_cell_from_subcells(cell: WebMercatorCell, tile_directory: s
     i0 = 2 * cell.i
     j0 = 2 * cell.j
 
-    margin=8
+    margin = _MERGE_MARGIN
+    # the 16 subcells cover every pixel, missing ones are read as zeros, so
+    # the array does not need to be initialised
     data = np.ndarray((256+2*margin, 256+2*margin), dtype=INTERMEDIATE_DTYPE)
-    data.fill(0)
-
-    # core data
-    data[margin:128+margin,margin:128+margin] = _get_heightdata(tile_directory, lvl, i0, j0)
-    data[margin:128+margin,128+margin:256+margin] = _get_heightdata(tile_directory, lvl, i0+1, j0)
-    data[128+margin:256+margin,margin:128+margin] = _get_heightdata(tile_directory, lvl, i0, j0+1)
-    data[128+margin:256+margin,128+margin:256+margin] = _get_heightdata(tile_directory, lvl, i0+1, j0+1)
-
-    # margins
-    data[:margin,:margin] = _get_heightdata(tile_directory, lvl, i0-1, j0-1)[-margin:,-margin:]
-    data[:margin,margin:128+margin] = _get_heightdata(tile_directory, lvl, i0, j0-1)[-margin:,:]
-    data[:margin,128+margin:256+margin] = _get_heightdata(tile_directory, lvl, i0+1, j0-1)[-margin:,:]
-    data[:margin,256+margin:] = _get_heightdata(tile_directory, lvl, i0+2, j0-1)[-margin:,:margin]
-
-    data[margin:128+margin,:margin] = _get_heightdata(tile_directory, lvl, i0-1, j0)[:,-margin:]
-    data[margin:128+margin,256+margin:] = _get_heightdata(tile_directory, lvl, i0+2, j0)[:,:margin]
-
-    data[128+margin:256+margin,:margin] = _get_heightdata(tile_directory, lvl, i0-1, j0+1)[:,-margin:]
-    data[128+margin:256+margin,256+margin:] = _get_heightdata(tile_directory, lvl, i0+2, j0+1)[:,:margin]
 
-    data[256+margin:,:margin] = _get_heightdata(tile_directory, lvl, i0-1, j0+2)[:margin,-margin:]
-    data[256+margin:,margin:128+margin] = _get_heightdata(tile_directory, lvl, i0, j0+2)[:margin,:]
-    data[256+margin:,128+margin:256+margin] = _get_heightdata(tile_directory, lvl, i0+1, j0+2)[:margin,:]
-    data[256+margin:,256+margin:] = _get_heightdata(tile_directory, lvl, i0+2, j0+2)[:margin,:margin]
+    for di, dj, source, destination in _MERGE_NEIGHBOURS:
+        data[destination] = _get_heightdata(tile_directory, lvl, i0+di, j0+dj)[source]
 
     hillshade_with_margin = to_hillshade(data)
     crop_box = (margin, margin, 256+margin, 256+margin)
@@ -242,27 +303,45 @@ def _generate_merged_cell_from_subcells(cell: WebMercatorCell, tile_directory: s
             .resize((128,128), resample=Image.Resampling.BILINEAR) \
             .convert(mode='I')
 
-        with open(os.path.join(dirname, F'{cell.j}.hgt.pgm'), 'wb') as f:
-            heights.save(f, 'PPM')
+        _save_heightdata(dirname, cell.j, heights)
 
 
-def hierarchically_merge_lower_level_cells(all_cells: Sequence[WebMercatorCell], tile_directory: str, maxlevel: int = 11, minlevel: int = 0, pool: Pool | None = None):
+def hierarchically_merge_lower_level_cells(cells_by_level: Sequence[Sequence[WebMercatorCell]], tile_directory: str, maxlevel: int = 11, minlevel: int = 0, executor: Executor | None = None):
     for level in range(maxlevel, minlevel - 1, -1):
-        cells = list(filter(lambda v: v.level == level, all_cells))
+        cells = cells_by_level[level]
 
         logger.info('Generating %d high-level cells of level %d from the height data of level %d.', len(cells), level, level+1)
 
-        if pool:
-            pool.starmap(_generate_merged_cell_from_subcells, zip(cells, repeat(tile_directory), repeat(level)))
+        if executor:
+            # each level needs the complete level below, including the
+            # neighbours of each cell for the margins
+            list(executor.map(_generate_merged_cell_from_subcells, cells, repeat(tile_directory), repeat(level), chunksize=16))
         else:
             for cell in cells:
                 _generate_merged_cell_from_subcells(cell, tile_directory, level)
 
 
+_worker_checker: EmptyChecker | None = None
+_worker_threads: int | None = None
+
+
+def _init_worker(checker: EmptyChecker, threads: int):
+    global _worker_checker, _worker_threads
+    _worker_checker = checker
+    _worker_threads = threads
+    _join_buffer.keep = True
+
+
+def _generate_block(node: WebMercatorCell, tile_directory: str, level: int):
+    generate_mercator_tile_grid(node, tile_directory, _worker_checker, level, threads=_worker_threads)
+
+
 def generate_tiles(
     min_level: int,
     max_level: int,
     tile_directory: str,
+    processes: int | None = None,
+    block_processes: int = 2,
 ):
     p = Path(tile_directory)
     if p.exists():
@@ -271,21 +350,29 @@ def generate_tiles(
     p.mkdir(exist_ok=False, parents=True)
 
     root = generate_webmercator_grid(max_level)
-    all_cells = list(filter(lambda cell: cell.level >= min_level, root.flatten()))
-    logger.info('Generated %d cells between levels %d and %d.', len(all_cells), min_level, max_level)
+    cells_by_level = root.cells_by_level()
+    logger.info('Generated %d cells between levels %d and %d.', sum(len(v) for v in cells_by_level[min_level:]), min_level, max_level)
     checker = prune_empties(root)
-    all_cells = list(filter(lambda cell: cell.level >= min_level, root.flatten()))
-    logger.info('Pruned down to %d cells.', len(all_cells))
+    cells_by_level = root.cells_by_level()
+    logger.info('Pruned down to %d cells.', sum(len(v) for v in cells_by_level[min_level:]))
 
-    pool = Pool(2)
-    maxlevel_count = sum(v.level == max_level for v in all_cells)
+    maxlevel_count = len(cells_by_level[max_level])
 
-    # on a 32GB RAM machine, two threads can feasibly create higher-level tiles
-    # from a composite image of level 7 before too much RAM is used
+    # on a 32GB RAM machine, two processes can feasibly create higher-level
+    # tiles from a composite image of level 7 before too much RAM is used.
+    # the blocks therefore get their own pool of block_processes workers,
+    # which exit (and release their memory) before the lower levels are merged
 
     blocklevel = max(min_level, 7, max_level - 5)  # have blocks of a size of 1024 (32x32) ideally
-    blocklevel_cells = list(filter(lambda n: n.level == blocklevel, root.flatten()))
+    blocklevel_cells = cells_by_level[blocklevel]
     logger.info('Generating %d cells of level %d in %d blocks of level %d.', maxlevel_count, max_level, len(blocklevel_cells), blocklevel)
 
-    pool.starmap(generate_mercator_tile_grid, zip(blocklevel_cells, repeat(tile_directory), repeat(checker), repeat(max_level)))
-    hierarchically_merge_lower_level_cells(all_cells, tile_directory=tile_directory, minlevel=min_level, maxlevel=max_level - 1, pool=Pool(6))
\ No newline at end of file
+    # the empty checker is sent to each worker once, not with every block.
+    # the CPUs are split between the blocks running at the same time
+    threads = max(1, (os.cpu_count() or 1) // block_processes)
+    with ProcessPoolExecutor(max_workers=block_processes, initializer=_init_worker, initargs=(checker, threads)) as executor:
+        list(executor.map(_generate_block, blocklevel_cells, repeat(tile_directory), repeat(max_level)))
+
+    # merging needs little memory, so all processes are used for it
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        hierarchically_merge_lower_level_cells(cells_by_level, tile_directory=tile_directory, minlevel=min_level, maxlevel=max_level - 1, executor=executor)
@@ -1,12 +1,17 @@
-from typing import List, Sequence, Generator
+from functools import partial
+from multiprocessing.pool import Pool
+from typing import List, Sequence, Generator, Tuple
 import io
 import gzip
 
-from geojson import FeatureCollection, Feature, load, dump, Polygon
-from turfpy.transformation import intersect
+import numpy as np
+import shapely
+from geojson import load, dump
+from shapely import STRtree, box
+from shapely.geometry import shape
 
-from .webmercatorcell import WebMercatorCell, generate_webmercator_grid
-from .mercator import proj_mercator, invert_mercator
+from .webmercatorcell import WebMercatorCell, generate_webmercator_grid, cells_to_latlng_bounds, cells_to_soa
+from .mercator import proj_mercator
 from .logger import logger
 
 
@@ -24,87 +29,93 @@ def generate_empties_file(
             f.write(F'{tile.level}/{tile.i}/{tile.j}.png\n'.encode())
 
 
+_polygon_tree: STRtree | None = None
+
+
+def _init_worker(polygons: Sequence[shapely.Geometry]):
+    global _polygon_tree
+    _polygon_tree = STRtree(polygons)
+
+
+def _find_empty_cells(intermediate_cell: WebMercatorCell, max_level: int) -> Tuple[Tuple[int, int, int], np.ndarray, np.ndarray, int]:
+    '''
+    Find the empty cells of level max_level within an intermediate cell.
+    Returns the level, i, and j of the intermediate cell, the i and j indices
+    of the empty cells, and the number of cells checked. Only indices are
+    returned, so the subtree is not sent back to the parent process.
+    '''
+    # the cell is sent to the worker without its children, they are
+    # regenerated here instead of being pickled
+    intermediate_cell.full_recursive_subdivide(max_level)
+
+    # reduce polygons
+    lat0, lng0, lat1, lng1 = intermediate_cell.latlng_corners()
+
+    # lat0 > lat1
+    intermediate_box = box(lng0, lat1, lng1, lat0)
+    candidates = _polygon_tree.query(intermediate_box, predicate='intersects')
+    polygons_clipped = shapely.intersection(_polygon_tree.geometries.take(candidates), intermediate_box)
+    clipped_tree = STRtree(polygons_clipped[~shapely.is_empty(polygons_clipped)])
+
+    highest_level_cells = intermediate_cell.cells_at_level(max_level)
+    lat0, lng0, lat1, lng1 = cells_to_latlng_bounds(highest_level_cells)
+
+    # cells outside of the SRTM coverage are always empty
+    in_coverage = (lat0 >= -60) & (lat1 <= 60)
+    cell_indices, _ = clipped_tree.query(box(lng0, lat1, lng1, lat0), predicate='intersects')
+    does_intersect = np.zeros(len(highest_level_cells), dtype=bool)
+    does_intersect[cell_indices] = True
+    does_intersect &= in_coverage
+
+    _, i, j = cells_to_soa(highest_level_cells)
+    key = (intermediate_cell.level, intermediate_cell.i, intermediate_cell.j)
+    return key, i[~does_intersect], j[~does_intersect], len(highest_level_cells)
+
+
 def generate_list_of_empty_tiles(
     geojson_file: io.TextIOWrapper,
     min_level: int = 0,
     max_level: int = 12,
 ) -> Sequence[WebMercatorCell]:
-    empties = set()
-
     j = load(geojson_file)
-    polygons = FeatureCollection(list(filter(lambda feature: 'Polygon' in feature['geometry']['type'], j['features'])))
+    polygons = [shape(feature['geometry']) for feature in j['features'] if 'Polygon' in feature['geometry']['type']]
 
-    logger.info('Loaded %d Polygon and MultiPolygon features to compare against.', len(polygons['features']))
+    logger.info('Loaded %d Polygon and MultiPolygon features to compare against.', len(polygons))
 
     root = generate_webmercator_grid(max_level)
-    all_cells = list(filter(lambda v: v.level >= min_level, root.flatten()))
+    cells_by_level = root.cells_by_level()
 
-    logger.info('Generated %d WebMercator cells between levels %d and %d.', len(all_cells), min_level, max_level)
+    logger.info('Generated %d WebMercator cells between levels %d and %d.', sum(len(v) for v in cells_by_level[min_level:]), min_level, max_level)
 
     # clip intersection polygons for sub-areas, then check all cells of the highest level first
     # cells of level N-1 are empty if all their direct children (level N) are empty
 
-    intermediate_cells = list(filter(lambda v: v.level == max(min_level, max_level - 7), all_cells))
-    for intermediate_cell_index, intermediate_cell in enumerate(intermediate_cells):
-        # reduce polygons
-        lat0, lng0 = invert_mercator(intermediate_cell.x0, intermediate_cell.y0)
-        lat1, lng1 = invert_mercator(intermediate_cell.x1, intermediate_cell.y1)
-
-        polygon = Feature(geometry=Polygon([[
-            (lng0, lat0),
-            (lng1, lat0),
-            (lng1, lat1),
-            (lng0, lat1),
-            (lng0, lat0),
-        ]]))
-        p2 = []
-        for p in polygons['features']:
-            v = intersect([p, polygon])
-            if v is not None:
-                p2.append(v)
-
-        polygons_clipped = FeatureCollection(p2)
-
-        highest_level_cells = list(filter(lambda v: v.level == max_level, intermediate_cell.flatten()))
-        empty_count = 0
-        for cell in highest_level_cells:
-            lat0, lng0 = invert_mercator(cell.x0, cell.y0)
-            lat1, lng1 = invert_mercator(cell.x1, cell.y1)
-
-            polygon = Feature(geometry=Polygon([[
-                (lng0, lat0),
-                (lng1, lat0),
-                (lng1, lat1),
-                (lng0, lat1),
-                (lng0, lat0),
-            ]]))
-
-            # lat0 > lat1
-            if lat0 < -60:
-                does_intersect = False
-            elif lat1 > 60:
-                does_intersect = False
-            else:
-                does_intersect = any(map(lambda f: intersect([f, polygon]) is not None, polygons_clipped['features']))
-
-            if not does_intersect:
-                empties.add(cell)
-                empty_count += 1
-
-        logger.info('Found %d (of %d) empty cells of level %d in partition cell (%s, %d/%d).', empty_count, len(highest_level_cells), max_level, intermediate_cell, intermediate_cell_index + 1, len(intermediate_cells))
+    intermediate_cells = [
+        WebMercatorCell(cell.level, cell.i, cell.j, cell.x0, cell.x1, cell.y0, cell.y1, None, None, None, None)
+        for cell in cells_by_level[max(min_level, max_level - 7)]
+    ]
 
+    bitmap = np.zeros((1 << max_level, 1 << max_level), dtype=bool)
+    with Pool(initializer=_init_worker, initargs=(polygons,)) as pool:
+        results = pool.imap_unordered(partial(_find_empty_cells, max_level=max_level), intermediate_cells, chunksize=4)
+        for intermediate_cell_index, ((level, cell_i, cell_j), i, j, cell_count) in enumerate(results):
+            bitmap[i, j] = True
 
-    # go up the hierarchy
-    for level in range(max_level - 1, min_level - 1, -1):
-        cells_of_level = list(filter(lambda v: v.level == level, all_cells))
-        empty_count = 0
+            logger.info('Found %d (of %d) empty cells of level %d in partition cell %d/%d of level %d (%d/%d).', len(i), cell_count, max_level, cell_i, cell_j, level, intermediate_cell_index + 1, len(intermediate_cells))
 
-        for cell in cells_of_level:
+    # go up the hierarchy
+    # a cell is empty if all four of its children are, which is an AND over
+    # each 2x2 block of the bitmap of empty cells of the level below
+    empties = []
+    for level in range(max_level, min_level - 1, -1):
+        if level < max_level:
+            bitmap = bitmap[0::2,0::2] & bitmap[1::2,0::2] & bitmap[0::2,1::2] & bitmap[1::2,1::2]
 
-            if cell.cell_0 in empties and cell.cell_1 in empties and cell.cell_2 in empties and cell.cell_3 in empties:
-                empty_count += 1
-                empties.add(cell)
+        cells_of_level = cells_by_level[level]
+        _, i, j = cells_to_soa(cells_of_level)
+        empty_cells = [cells_of_level[k] for k in np.flatnonzero(bitmap[i, j])]
+        empties.extend(empty_cells)
 
-        logger.info('Found %d (of %d) empty cells of level %d.', empty_count, len(cells_of_level), level)
+        logger.info('Found %d (of %d) empty cells of level %d.', len(empty_cells), len(cells_of_level), level)
 
-    return list(empties)
+    return empties
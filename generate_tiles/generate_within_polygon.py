@@ -11,6 +11,6 @@ def generate_within_polygon_checker(features: Sequence[Feature]) -> Callable[[We
     def checker(cell: WebMercatorCell) -> bool:
         polygon = cell.to_geojson()
 
-        return any(map(lambda feature: intersect([feature, polygon]) is not None, features))
+        return any(intersect([feature, polygon]) is not None for feature in features)
 
     return checker
@@ -4,10 +4,9 @@ import os.path
 import zipfile
 
 import numpy as np
-import earthpy.spatial as es
 from PIL import Image
 
-from .mercator import proj_mercator, invert_mercator
+from .mercator import proj_mercator, invert_mercator_np
 from .constants import IN_DTYPE, INTERMEDIATE_DTYPE, INTERMEDIATE_NAN, DIM, HILLSHADE_AZIMUTH, OUT_DTYPE
 from .logger import logger
 
@@ -37,30 +36,20 @@ def equirectangular_image_to_mercator(
     width = dxd
     height = math.floor(dy * pixel_ratio)
 
-    #np.seterr(all='raise')
+    # row boundaries of all output rows, row 0 is at the top. these are
+    # computed for all rows at once, the averaging itself is already
+    # vectorized along each row
+    rows = np.arange(height + 1)
+    row_y = y1 - rows / height * dy
+    lat_rows, _ = invert_mercator_np(np.zeros_like(row_y), row_y)
+    delta_from_top_eqrect = lat + dlat - lat_rows
 
-    # row 0 is at the top
-    data_out = np.ndarray((height, width), INTERMEDIATE_DTYPE)
-    for row in range(height):
-        row_y0 = y1 - row/height * dy
-        row_y1 = y1 - (row+1)/height * dy
-
-        lat_row_0, _ = invert_mercator(0, row_y0)
-        lat_row_1, _ = invert_mercator(0, row_y1)
-
-        delta_from_top_eqrect_0 = lat + dlat - lat_row_0
-        delta_from_top_eqrect_1 = lat + dlat - lat_row_1
-
-        index_0 = max(0, math.floor(delta_from_top_eqrect_0 * tile_scale))
-        index_1 = math.ceil(delta_from_top_eqrect_1 * tile_scale)
+    index_0 = np.maximum(0, np.floor(delta_from_top_eqrect[:-1] * tile_scale).astype(np.int64))
+    index_1 = np.ceil(delta_from_top_eqrect[1:] * tile_scale).astype(np.int64)
 
-        if index_0 < 0 or index_1 >= data.shape[0]:
-            pass
-            #logger.warning('index_0 = %d, index_1 = %d, data.shape = %s, lat_row_0 = %f, lat_row_1 = %f, lat0 = %f, lng0 = %f, lat1 = %f, lng1 = %f',
-            #               index_0, index_1, data.shape,
-            #               lat_row_0, lat_row_1, lat, lng, lat+dlat, lng+dlng)
-        data_row = data[index_0:index_1+1,:].mean(axis=0)
-        data_out[row,:] = data_row
+    data_out = np.ndarray((height, width), INTERMEDIATE_DTYPE)
+    for row, (row_index_0, row_index_1) in enumerate(zip(index_0.tolist(), index_1.tolist())):
+        np.mean(data[row_index_0:row_index_1+1,:], axis=0, out=data_out[row,:])
 
     return data_out
 
@@ -86,23 +75,56 @@ def read_cell(lat: int, lng: int) -> np.ndarray:
         with zf.open(zf.namelist()[0]) as f:  # sometimes, the file is called '{fragment}.SRTMGL1.hgt', but mostly the '.SRTMGL1' part is missing from the name
             decompressed = f.read()
 
-            data = np.ndarray((DIM, DIM), IN_DTYPE, decompressed)
-            no_value = (data == -32768)
+            data = np.frombuffer(decompressed, IN_DTYPE).reshape((DIM, DIM))
 
-            data2 = np.asfarray(data, dtype=INTERMEDIATE_DTYPE)
-            data2[no_value] = INTERMEDIATE_NAN
+            data2 = data.astype(INTERMEDIATE_DTYPE)
+            np.copyto(data2, INTERMEDIATE_NAN, where=data == -32768)
 
             return data2
 
 
+def hillshade(data: np.ndarray, azimuth: float, altitude: float = 30) -> np.ndarray:
+    '''
+    Calculate hillshade values between 0 and 255 from a height map, like
+    ``earthpy.spatial.hillshade`` does. The sines and cosines of slope and
+    aspect are resolved algebraically:
+
+        shade = (sin(alt) + cos(alt) * (dy * cos(az) - dx * sin(az))) / sqrt(1 + dx^2 + dy^2)
+
+    so that apart from the gradient, only one square root and a few in-place
+    operations on the full array are needed.
+    '''
+    dx, dy = np.gradient(data)
+
+    azimuth_rad = (360 - azimuth) * math.pi / 180 - math.pi / 2
+    altitude_rad = altitude * math.pi / 180
+
+    norm = dx * dx
+    norm += dy * dy
+    norm += 1
+    np.sqrt(norm, out=norm)
+
+    dx *= -math.cos(altitude_rad) * math.sin(azimuth_rad)
+    dy *= math.cos(altitude_rad) * math.cos(azimuth_rad)
+    dy += dx
+    dy += math.sin(altitude_rad)
+    dy /= norm
+
+    # [-1, 1] -> [0, 255]
+    dy += 1
+    dy *= 255 / 2
+
+    return dy
+
+
 def to_hillshade(data: np.ndarray) -> Image.Image:
     '''
     Create hillshading luminance data from a height map.
     '''
-    hillshade = es.hillshade(data, azimuth=HILLSHADE_AZIMUTH)
+    hillshade_values = hillshade(data, azimuth=HILLSHADE_AZIMUTH)
 
     # to output type
-    out_array = np.asarray(hillshade, OUT_DTYPE)
+    out_array = np.asarray(hillshade_values, OUT_DTYPE)
 
     # lighten
     out_array = 255 - ((255 - out_array) // 3)
@@ -1,6 +1,9 @@
 import math
+from functools import lru_cache
 from typing import Tuple
 
+import numpy as np
+
 R = 6371
 
 def proj_mercator(lat: float, lng: float) -> Tuple[float, float]:
@@ -17,4 +20,33 @@ def invert_mercator(x: float, y: float) -> Tuple[float, float]:
     res_inner = math.atan(res_tan)
     lat = 360 * (res_inner - math.pi/4) / math.pi
 
-    return lat, lng
\ No newline at end of file
+    return lat, lng
+
+
+@lru_cache(maxsize=None)
+def invert_mercator_latitude(y: float) -> float:
+    '''
+    Latitude of a Mercator y coordinate. The latitude does not depend on x, and
+    the cell edges of the WebMercator grid only take a few distinct values, so
+    the results are memoized.
+    '''
+    return invert_mercator(0, y)[0]
+
+
+@lru_cache(maxsize=None)
+def invert_mercator_longitude(x: float) -> float:
+    '''
+    Longitude of a Mercator x coordinate, memoized like
+    ``invert_mercator_latitude``.
+    '''
+    return invert_mercator(x, 0)[1]
+
+
+def invert_mercator_np(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Vectorized version of ``invert_mercator``.
+    '''
+    lng = (x * 180 / math.pi) / R
+    lat = 360 * (np.arctan(np.exp(y / R)) - math.pi/4) / math.pi
+
+    return lat, lng
@@ -1,18 +1,50 @@
 import gzip
-from typing import Set, Tuple
+from typing import Dict, Set, Tuple
+
+import numpy as np
 
 from .webmercatorcell import WebMercatorCell
 from .logger import logger
 
 
 class EmptyChecker:
-    _empty_set: Set[Tuple[int, int, int]]
+    '''
+    Look-up of empty tiles. The tiles are kept as one boolean bitmap of
+    2^level x 2^level per level, indexed by [i, j], so that checking a tile
+    is a single array access instead of hashing an index tuple.
+    '''
+    _bitmaps: Dict[int, np.ndarray]
+    _count: int
 
     def __init__(self, empty_set: Set[Tuple[int, int, int]]):
-        self._empty_set = empty_set
+        self._bitmaps = dict()
+        self._count = len(empty_set)
+
+        keys = np.array(list(empty_set), dtype=np.int64).reshape(-1, 3)
+        for level in np.unique(keys[:,0]).tolist():
+            level_keys = keys[keys[:,0] == level]
+            bitmap = np.zeros((1 << level, 1 << level), dtype=bool)
+            bitmap[level_keys[:,1], level_keys[:,2]] = True
+            self._bitmaps[level] = bitmap
+
+    def __len__(self) -> int:
+        return self._count
 
     def __call__(self, cell: WebMercatorCell) -> bool:
-        return (cell.level, cell.i, cell.j) in self._empty_set
+        bitmap = self._bitmaps.get(cell.level)
+        return bitmap is not None and bool(bitmap[cell.i, cell.j])
+
+    def empty_mask(self, levels: np.ndarray, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+        '''
+        Check many tiles at once. Returns a boolean array that is true where
+        the tile is empty.
+        '''
+        mask = np.zeros(len(levels), dtype=bool)
+        for level, bitmap in self._bitmaps.items():
+            selection = levels == level
+            mask[selection] = bitmap[i[selection], j[selection]]
+
+        return mask
 
 
 def load_empties():
@@ -44,7 +76,7 @@ def _inner_prune_empties(root: WebMercatorCell, checker: EmptyChecker):
 
 def prune_empties(root: WebMercatorCell):
     checker = load_empties()
-    logger.info('Pruning %d empty cells.', len(checker._empty_set))
+    logger.info('Pruning %d empty cells.', len(checker))
     pc = _inner_prune_empties(root, checker)
     logger.info('Actively pruned %d.', pc)
 
@@ -1,5 +1,5 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class LinearInterpolator:
@@ -8,8 +8,17 @@ class LinearInterpolator:
     range_0: float
     range_1: float
 
+    _domain_delta: float = field(init=False, repr=False, compare=False)
+    _range_delta: float = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # the extents are constant, so they are only computed once. the
+        # evaluation order in __call__ is unchanged, so results are identical
+        self._domain_delta = self.domain_1 - self.domain_0
+        self._range_delta = self.range_1 - self.range_0
+
     def __call__(self, value: float) -> float:
-        return self.range_0 + (value - self.domain_0) / (self.domain_1 - self.domain_0) * (self.range_1 - self.range_0)
+        return self.range_0 + (value - self.domain_0) / self._domain_delta * self._range_delta
 
     def invert(self) -> LinearInterpolator:
-        return LinearInterpolator(self.range_0, self.range_1, self.domain_0, self.domain_1)
\ No newline at end of file
+        return LinearInterpolator(self.range_0, self.range_1, self.domain_0, self.domain_1)
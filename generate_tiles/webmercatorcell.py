@@ -1,13 +1,31 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import Callable, Sequence, List, Tuple
+from typing import Callable, Iterator, Sequence, List, Tuple
 import math
 
+import numpy as np
 from geojson import Feature, Polygon
 
-from .mercator import proj_mercator, invert_mercator
+from .mercator import proj_mercator, invert_mercator, invert_mercator_np, invert_mercator_latitude, invert_mercator_longitude
 
-@dataclass
+
+def pack_cell_keys(levels: np.ndarray, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+    '''
+    Pack tile addresses into single 64 bit integers, for compact sorting and
+    look-ups. Valid up to level 29, where i and j still fit into 29 bits each.
+    '''
+    return (levels.astype(np.int64) << 58) | (i.astype(np.int64) << 29) | j.astype(np.int64)
+
+
+def unpack_cell_keys(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Inverse of ``pack_cell_keys``.
+    '''
+    mask = (1 << 29) - 1
+    return keys >> 58, (keys >> 29) & mask, keys & mask
+
+
+@dataclass(slots=True)
 class WebMercatorCell:
     level: int
     i: int
@@ -37,10 +55,10 @@ class WebMercatorCell:
             ('cell_2', 2 * self.i, 2 * self.j + 1, self.x0, xmid, ymid, self.y1),
             ('cell_3', 2 * self.i + 1, 2 * self.j + 1, xmid, self.x1, ymid, self.y1),
         ]:
-            cell = self.__getattribute__(cell_key) or WebMercatorCell(self.level + 1, i, j, x0, x1, y0, y1, None, None, None, None)
+            cell = getattr(self, cell_key) or WebMercatorCell(self.level + 1, i, j, x0, x1, y0, y1, None, None, None, None)
             if condition(cell):
-                self.__setattr__(cell_key, cell)
-                self.__getattribute__(cell_key).conditional_recursive_subdivide(condition, max_depth)
+                setattr(self, cell_key, cell)
+                cell.conditional_recursive_subdivide(condition, max_depth)
 
 
     def full_recursive_subdivide(self, max_depth: int = 0):
@@ -53,11 +71,24 @@ class WebMercatorCell:
 
 
     def contains_srtm_data(self) -> bool:
-        lat0, _ = invert_mercator(self.x0, self.y0)
-        lat1, _ = invert_mercator(self.x1, self.y1)
+        lat0, _, lat1, _ = self.latlng_corners()
         return not (lat1 > 60 or lat0 < -60)
 
 
+    def latlng_corners(self) -> Tuple[float, float, float, float]:
+        '''
+        Latitude and longitude of the corners (x0, y0) and (x1, y1), as lat0,
+        lng0, lat1, lng1. Neighbouring cells share their edges, so the
+        conversions are looked up from a cache.
+        '''
+        return (
+            invert_mercator_latitude(self.y0),
+            invert_mercator_longitude(self.x0),
+            invert_mercator_latitude(self.y1),
+            invert_mercator_longitude(self.x1),
+        )
+
+
     def get_srtm_tile_indices(self, mercator_margin: float = 0.03) -> List[Tuple[int, int]]:
         '''
         Mercator margin: percentage increase in tile width and height as a safe
@@ -79,18 +110,76 @@ class WebMercatorCell:
         return tiles
 
 
-    def flatten(self) -> Sequence[WebMercatorCell]:
-        l = [self]
-        if self.cell_0:
-            l += self.cell_0.flatten()
-        if self.cell_1:
-            l += self.cell_1.flatten()
-        if self.cell_2:
-            l += self.cell_2.flatten()
-        if self.cell_3:
-            l += self.cell_3.flatten()
+    def flatten(self) -> Iterator[WebMercatorCell]:
+        '''
+        Iterate over the cell and all its descendants in depth-first order
+        (each cell before its children cell_0 to cell_3). The tree is walked
+        with an explicit stack, so no intermediate lists are built.
+        '''
+        stack = [self]
+        while stack:
+            cell = stack.pop()
+            yield cell
+
+            # push in reverse so that cell_0 is visited first
+            for child in (cell.cell_3, cell.cell_2, cell.cell_1, cell.cell_0):
+                if child is not None:
+                    stack.append(child)
+
 
-        return l
+    def flatten_soa(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Like ``flatten``, but return only the level, i, and j indices of the
+        cells, as three parallel arrays. The arrays are filled during the
+        traversal, so no list of all cells is built.
+        '''
+        indices = np.fromiter(
+            ((cell.level, cell.i, cell.j) for cell in self.flatten()),
+            dtype=[('level', np.int16), ('i', np.int32), ('j', np.int32)],
+        )
+
+        return indices['level'], indices['i'], indices['j']
+
+
+    def cells_at_level(self, level: int) -> List[WebMercatorCell]:
+        '''
+        Collect all descendant cells (or the cell itself) of the given level,
+        in the same order as in ``flatten``. The tree is expanded one level at
+        a time, so only the interior cells above the target level are visited
+        and no per-cell level checks are necessary.
+        '''
+        cells = [self]
+        for _ in range(level - self.level):
+            cells = [
+                child
+                for cell in cells
+                for child in (cell.cell_0, cell.cell_1, cell.cell_2, cell.cell_3)
+                if child is not None
+            ]
+
+        return cells if level >= self.level else []
+
+
+    def cells_by_level(self) -> List[List[WebMercatorCell]]:
+        '''
+        Collect all cells of the tree in a single pass, grouped by level. Entry
+        L of the returned list holds the cells of level L, in the same order as
+        in ``flatten``. The entries for levels above this cell are empty. The
+        index reflects the tree at the time of the call, so it has to be
+        rebuilt after pruning.
+        '''
+        levels: List[List[WebMercatorCell]] = [[] for _ in range(self.level)]
+        cells = [self]
+        while cells:
+            levels.append(cells)
+            cells = [
+                child
+                for cell in cells
+                for child in (cell.cell_0, cell.cell_1, cell.cell_2, cell.cell_3)
+                if child is not None
+            ]
+
+        return levels
 
 
     def prune_children(self, condition: Callable[[WebMercatorCell], bool]):
@@ -114,8 +203,7 @@ class WebMercatorCell:
 
 
     def to_geojson(self) -> Feature:
-        lat0, lng0 = invert_mercator(self.x0, self.y0)
-        lat1, lng1 = invert_mercator(self.x1, self.y1)
+        lat0, lng0, lat1, lng1 = self.latlng_corners()
 
         return Feature(geometry=Polygon(coordinates=[[
             [lng0, lat0],
@@ -126,6 +214,37 @@ class WebMercatorCell:
         ]]))
 
 
+def cells_to_soa(cells: Sequence[WebMercatorCell]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Convert a sequence of cells into three parallel arrays of their level, i,
+    and j indices, for vectorized selection and sorting.
+    '''
+    count = len(cells)
+    levels = np.fromiter((cell.level for cell in cells), dtype=np.int16, count=count)
+    i = np.fromiter((cell.i for cell in cells), dtype=np.int32, count=count)
+    j = np.fromiter((cell.j for cell in cells), dtype=np.int32, count=count)
+
+    return levels, i, j
+
+
+def cells_to_latlng_bounds(cells: Sequence[WebMercatorCell]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Convert the corners of many cells from Mercator to latitude and longitude
+    at once. Returns the arrays lat0, lng0, lat1, lng1, where (lat0, lng0) is
+    the corner (x0, y0) and (lat1, lng1) is the corner (x1, y1) of each cell.
+    '''
+    count = len(cells)
+    x0 = np.fromiter((cell.x0 for cell in cells), dtype=np.float64, count=count)
+    x1 = np.fromiter((cell.x1 for cell in cells), dtype=np.float64, count=count)
+    y0 = np.fromiter((cell.y0 for cell in cells), dtype=np.float64, count=count)
+    y1 = np.fromiter((cell.y1 for cell in cells), dtype=np.float64, count=count)
+
+    lat0, lng0 = invert_mercator_np(x0, y0)
+    lat1, lng1 = invert_mercator_np(x1, y1)
+
+    return lat0, lng0, lat1, lng1
+
+
 def generate_webmercator_grid(refine_to_level: int = 0) -> WebMercatorCell:
     x0, _ = proj_mercator(0, -180)
     x1, _ = proj_mercator(0, 180)